@@ -5,11 +5,143 @@ for on-device pharmaceutical NER in iOS apps
 """
 
 import coremltools as ct
+from coremltools.optimize.coreml import (
+    linear_quantize_activations,
+    linear_quantize_weights,
+    palettize_weights,
+    prune_weights,
+    OpLinearQuantizerConfig,
+    OpPalettizerConfig,
+    OpThresholdPrunerConfig,
+    OptimizationConfig,
+)
+import shutil
 import torch
 from transformers import AutoTokenizer, AutoModelForTokenClassification
+from transformers.models.distilbert import modeling_distilbert
 import numpy as np
+from scipy.special import softmax
 
-def convert_biomedical_ner_to_coreml():
+# Sequence lengths the converted model accepts. Short clinical utterances
+# run at the nearest bucket instead of paying for a full 512-token pass
+# (BERT attention is O(n^2) in sequence length).
+SEQUENCE_BUCKETS = (32, 64, 128, 256, 512)
+
+# Batch size for bulk de-identification workloads. ANE throughput scales
+# near-linearly with batch for BERT until L2 pressure hits.
+BATCH_SIZE = 8
+
+# Entity types the app actually surfaces. The full classifier head covers
+# 84 labels; rows for the rest are zeroed in the pruned model variant.
+KEPT_ENTITY_TYPES = {
+    "Medication",
+    "Dosage",
+    "Frequency",
+    "Duration",
+    "Administration",
+    "Disease_disorder",
+    "Sign_symptom",
+    "Lab_value",
+    "Diagnostic_procedure",
+    "Therapeutic_procedure",
+    "Age",
+    "Sex",
+    "Clinical_event",
+}
+
+# Real clinical sentences used both as the tracing example and to
+# calibrate activation ranges for the W4A8 variant (random token IDs
+# would produce garbage statistics)
+CALIBRATION_TEXTS = [
+    "Take 25mg of Lisinopril twice daily for hypertension",
+    "Patient was prescribed 500mg Metformin with meals for type 2 diabetes",
+    "Administer 10mg Atorvastatin at bedtime to lower cholesterol",
+    "Apply hydrocortisone cream 1% to affected area twice daily",
+    "Start Amoxicillin 875mg every 12 hours for 10 days for sinusitis",
+    "Increase Levothyroxine to 75mcg daily, recheck TSH in 6 weeks",
+    "Patient reports dizziness after starting Amlodipine 5mg",
+    "Discontinue Ibuprofen due to gastric irritation, switch to acetaminophen",
+    "Inject 40 units of insulin glargine subcutaneously each evening",
+    "Prescribed Sertraline 50mg once daily for major depressive disorder",
+    "Continue Warfarin 5mg, INR to be checked weekly",
+    "Albuterol inhaler two puffs every 4 hours as needed for wheezing",
+    "Omeprazole 20mg before breakfast for gastroesophageal reflux",
+    "Patient denies chest pain but reports shortness of breath on exertion",
+    "Furosemide 40mg each morning for lower extremity edema",
+    "Gabapentin titrated to 300mg three times daily for neuropathic pain",
+    "History of atrial fibrillation managed with Diltiazem 120mg",
+    "Prednisone taper starting at 40mg daily for asthma exacerbation",
+    "Clopidogrel 75mg daily following drug-eluting stent placement",
+    "Allergic to penicillin, developed hives and facial swelling",
+]
+
+def export_for_coreml(module, example_inputs, dynamic_shapes=None):
+    """Capture an ATen-level graph with torch.export. Unlike
+    torch.jit.trace it carries no dead branches from Python-level control
+    flow (the head_mask and output_attentions paths), so conversion is
+    faster and the resulting mlpackage smaller.
+
+    Without dynamic_shapes the ExportedProgram is specialized to the
+    example shapes, and the converter rejects any flexible input shapes
+    declared on top of it."""
+    with torch.no_grad():
+        exported = torch.export.export(module, example_inputs, dynamic_shapes=dynamic_shapes)
+    # coremltools only accepts the ATen/EDGE dialects
+    return exported.run_decompositions({})
+
+def simple_bidirectional_mask(config=None, inputs_embeds=None, attention_mask=None, **kwargs):
+    """Additive attention mask: 0 for real tokens, a large negative
+    number for padding. Same semantics as transformers'
+    create_bidirectional_mask, but built from plain broadcasting ops —
+    the stock builder emits fx nodes (new_ones and friends) the Core ML
+    converter does not support."""
+    if attention_mask is None:
+        return None
+    mask = attention_mask[:, None, None, :].to(inputs_embeds.dtype)
+    return (1.0 - mask) * torch.finfo(inputs_embeds.dtype).min
+
+class SplitEinsumSelfAttention(torch.nn.Module):
+    """Drop-in replacement for DistilBertSelfAttention using the
+    split-einsum layout (B, n_heads, head_dim, seq) instead of
+    HuggingFace's (B, n_heads, seq, head_dim), so the Neural Engine's
+    matmul units stream contiguously with fewer memory copies"""
+
+    def __init__(self, original):
+        super().__init__()
+        self.q_lin = original.q_lin
+        self.k_lin = original.k_lin
+        self.v_lin = original.v_lin
+        self.out_lin = original.out_lin
+        self.n_heads = original.n_heads
+        self.head_dim = original.attention_head_size
+        self.scale = original.attention_head_size ** -0.5
+
+    def forward(self, hidden_states, attention_mask=None, **kwargs):
+        batch, seq, _ = hidden_states.shape
+
+        def split_heads(x):
+            # (B, seq, dim) -> (B, n_heads, head_dim, seq)
+            return x.view(batch, -1, self.n_heads, self.head_dim).permute(0, 2, 3, 1)
+
+        q = split_heads(self.q_lin(hidden_states))
+        k = split_heads(self.k_lin(hidden_states))
+        v = split_heads(self.v_lin(hidden_states))
+
+        scores = torch.einsum("bhcs,bhct->bhst", q, k) * self.scale
+        # attention_mask is the additive mask DistilBertModel builds with
+        # create_bidirectional_mask: 0 for real tokens, a large negative
+        # number for padding
+        if attention_mask is not None:
+            scores = scores + attention_mask
+        weights = torch.softmax(scores, dim=-1)
+        context = torch.einsum("bhst,bhct->bhcs", weights, v)
+
+        # Back to (B, seq, dim) and through the output projection, which
+        # DistilBERT keeps inside the attention module
+        context = context.permute(0, 3, 1, 2).reshape(batch, seq, self.n_heads * self.head_dim)
+        return self.out_lin(context), weights
+
+def convert_biomedical_ner_to_coreml(joint_compress=False):
     """Convert the biomedical NER model to Core ML format"""
     
     # 1. Load the pre-trained model and tokenizer
@@ -24,15 +156,29 @@ def convert_biomedical_ner_to_coreml():
     print(f"Number of labels: {model.config.num_labels}")
     print(f"Label mapping: {model.config.id2label}")
     
-    # 2. Set model to evaluation mode
+    # 2. Set model to evaluation mode and swap every self-attention block
+    # for the split-einsum layout before tracing (applies to the chunked
+    # exports too, since they share these layer modules)
     model.eval()
-    
+    for layer in model.distilbert.transformer.layer:
+        layer.attention = SplitEinsumSelfAttention(layer.attention)
+    # Swap the mask builder too, for the same reason (see the helper)
+    modeling_distilbert.create_bidirectional_mask = simple_bidirectional_mask
+
     # 3. Define input specifications for Core ML
     max_sequence_length = 512  # BERT's typical max length
     
-    # Create example inputs for tracing
-    input_ids = torch.randint(0, tokenizer.vocab_size, (1, max_sequence_length))
-    attention_mask = torch.ones(1, max_sequence_length)
+    # Create example inputs for tracing from a real clinical sentence so
+    # the captured example has realistic token and activation statistics
+    calibration_batch = tokenizer(
+        CALIBRATION_TEXTS,
+        padding="max_length",
+        truncation=True,
+        max_length=max_sequence_length,
+        return_tensors="pt"
+    )
+    input_ids = calibration_batch["input_ids"][0:1]
+    attention_mask = calibration_batch["attention_mask"][0:1]
     
     # 4. Create a wrapper model that returns only logits (not dict)
     class NERModelWrapper(torch.nn.Module):
@@ -48,39 +194,61 @@ def convert_biomedical_ner_to_coreml():
     wrapped_model = NERModelWrapper(model)
     wrapped_model.eval()
     
-    # Trace the wrapped model
-    print("Tracing wrapped PyTorch model...")
-    with torch.no_grad():
-        traced_model = torch.jit.trace(
-            wrapped_model,
-            (input_ids, attention_mask),
-            strict=False
-        )
+    # Export the wrapped model with the batch and sequence dims dynamic,
+    # otherwise the enumerated shapes declared below would be rejected
+    # against a static (1, 512) graph. torch.export specializes size-1
+    # dims as static, so export from a 2-sentence example slice.
+    print("Exporting wrapped PyTorch model...")
+    batch_dim = torch.export.Dim("batch", min=1, max=BATCH_SIZE)
+    sequence_dim = torch.export.Dim("sequence", min=SEQUENCE_BUCKETS[0], max=SEQUENCE_BUCKETS[-1])
+    exported_model = export_for_coreml(
+        wrapped_model,
+        (calibration_batch["input_ids"][:2], calibration_batch["attention_mask"][:2]),
+        dynamic_shapes={
+            "input_ids": {0: batch_dim, 1: sequence_dim},
+            "attention_mask": {0: batch_dim, 1: sequence_dim},
+        }
+    )
     
     # 5. Convert to Core ML
     print("Converting to Core ML...")
     
-    # Define input types
+    # Define input types. The exported graph carries symbolic batch and
+    # sequence dims, and every enumerated shape must fall inside their
+    # ranges; short inputs then only pay for their bucket.
+    sequence_shapes = ct.EnumeratedShapes(
+        shapes=[(1, length) for length in SEQUENCE_BUCKETS] + [(BATCH_SIZE, 512)],
+        default=(1, 128)
+    )
     input_types = [
         ct.TensorType(
             name="input_ids",
-            shape=(1, max_sequence_length),
-            dtype=np.int32
+            shape=sequence_shapes,
+            dtype=np.int32  # vocab is ~30k entries, needs int32
         ),
         ct.TensorType(
-            name="attention_mask", 
-            shape=(1, max_sequence_length),
+            name="attention_mask",
+            shape=sequence_shapes,
+            # The mask is 0/1 per token, but int8/bool inputs are not
+            # supported below an iOS26 deployment target, so int32 it is
             dtype=np.int32
         )
     ]
     
     # Convert with proper configuration
     coreml_model = ct.convert(
-        traced_model,
+        exported_model,
         inputs=input_types,
         outputs=[ct.TensorType(name="logits")],
         minimum_deployment_target=ct.target.iOS18,  # Adjust as needed
-        compute_units=ct.ComputeUnit.ALL  # Use Neural Engine when available
+        # CPU_AND_NE keeps the BERT layers resident on the Neural Engine;
+        # ALL lets the planner place ops on the GPU, and the resulting
+        # CPU<->GPU copies dominate small-batch token classification
+        compute_units=ct.ComputeUnit.CPU_AND_NE,
+        # FP16 is already the MLProgram default, but pinning it documents
+        # the intent and keeps the converter from emitting FP32
+        # intermediates with extra cast ops
+        compute_precision=ct.precision.FLOAT16
     )
     
     # 6. Add metadata
@@ -98,32 +266,323 @@ def convert_biomedical_ner_to_coreml():
     output_path = "BiomedicalNER.mlpackage"
     coreml_model.save(output_path)
     print(f"Core ML model saved to: {output_path}")
+
+    # Also emit the pre-compiled .mlmodelc so the app can bundle it and
+    # skip the multi-second on-device compile at first launch
+    print("Pre-compiling model...")
+    reloaded_model = ct.models.MLModel(output_path)
+
+    # Warm up at the 64-token bucket — clinical prescription strings are
+    # almost always shorter than that — to verify the enumerated shapes
+    # accept a short input and to prime this process's plan cache. The
+    # copied .mlmodelc is unaffected; on-device, each shape is still
+    # planned on its first predict.
+    print("Warming up at the 64-token bucket...")
+    reloaded_model.predict({
+        "input_ids": np.zeros((1, 64), dtype=np.int32),
+        "attention_mask": np.ones((1, 64), dtype=np.int32)
+    })
+
+    compiled_path = reloaded_model.get_compiled_model_path()
+    shutil.copytree(compiled_path, "BiomedicalNER.mlmodelc", dirs_exist_ok=True)
+    print("Pre-compiled model saved to: BiomedicalNER.mlmodelc")
+
+    # 8. Also save a 6-bit palettized variant. BERT inference on the Neural
+    # Engine is memory-bound, so shrinking weight bytes directly improves
+    # throughput. Kept as a separate package so it can be A/B tested
+    # against the FP16 model.
+    print("Palettizing weights to 6-bit...")
+    palettize_config = OptimizationConfig(
+        global_config=OpPalettizerConfig(
+            mode="kmeans",
+            nbits=6,
+            granularity="per_grouped_channel",
+            group_size=16
+        )
+    )
+    palettized_model = palettize_weights(coreml_model, palettize_config)
+    palettized_path = "BiomedicalNER_6bit.mlpackage"
+    palettized_model.save(palettized_path)
+    print(f"6-bit palettized model saved to: {palettized_path}")
+
+    # Optional W4A8 variant (4-bit palettized weights + int8 activations),
+    # the best-performing path on A17pro/M4-class Neural Engines. Requires
+    # the iOS18 deployment target set above.
+    if joint_compress:
+        save_joint_compressed_model(coreml_model, tokenizer)
+
+    # Also export the model as two similarly-sized chunks. Keeping each
+    # chunk's weights L2-resident lets the Neural Engine use multiple
+    # cores more effectively than one monolithic graph.
+    convert_chunked_models(model, input_ids, attention_mask)
+
+    # Variant with the classifier head pruned to the entity types the
+    # app surfaces, with the zeroed rows stored sparsely
+    save_pruned_classifier_model(model, input_ids, attention_mask)
     
-    # 8. Save tokenizer and label info for iOS usage
+    # 9. Save tokenizer and label info for iOS usage
     save_tokenizer_info(tokenizer, model.config)
     
-    return coreml_model
+    return coreml_model, tokenizer, model.config.id2label
+
+def convert_chunked_models(model, input_ids, attention_mask):
+    """Split the DistilBERT model into two Core ML chunks chained at
+    runtime: embeddings + transformer layers 0-2, then layers 3-5 +
+    classifier"""
+
+    num_layers = len(model.distilbert.transformer.layer)
+    split_at = num_layers // 2
+    hidden_size = model.config.dim
+    config = model.config
+
+    class NERPart1(torch.nn.Module):
+        def __init__(self, original_model):
+            super().__init__()
+            self.embeddings = original_model.distilbert.embeddings
+            self.layers = original_model.distilbert.transformer.layer[:split_at]
+
+        def forward(self, input_ids, attention_mask):
+            hidden_states = self.embeddings(input_ids)
+            # Same additive mask DistilBertModel builds before its layers
+            mask = simple_bidirectional_mask(
+                config=config,
+                inputs_embeds=hidden_states,
+                attention_mask=attention_mask,
+            )
+            for layer in self.layers:
+                hidden_states = layer(hidden_states, attention_mask=mask)
+            return hidden_states
+
+    class NERPart2(torch.nn.Module):
+        def __init__(self, original_model):
+            super().__init__()
+            self.layers = original_model.distilbert.transformer.layer[split_at:]
+            self.classifier = original_model.classifier
+
+        def forward(self, hidden_states, attention_mask):
+            mask = simple_bidirectional_mask(
+                config=config,
+                inputs_embeds=hidden_states,
+                attention_mask=attention_mask,
+            )
+            for layer in self.layers:
+                hidden_states = layer(hidden_states, attention_mask=mask)
+            return self.classifier(hidden_states)
+
+    part1 = NERPart1(model).eval()
+    part2 = NERPart2(model).eval()
+
+    seq_length = input_ids.shape[1]
+    hidden_states = torch.zeros(1, seq_length, hidden_size)
+
+    print(f"Exporting chunk 1 (embeddings + transformer layers 0-{split_at - 1})...")
+    # Keep the sequence dim dynamic even though the chunk inputs are
+    # declared static: at a static 512 the embeddings' position-ids slice
+    # collapses to an aten.alias the converter cannot ingest
+    sequence_dim = torch.export.Dim("sequence", min=SEQUENCE_BUCKETS[0], max=SEQUENCE_BUCKETS[-1])
+    exported_part1 = export_for_coreml(
+        part1,
+        (input_ids, attention_mask),
+        dynamic_shapes={
+            "input_ids": {1: sequence_dim},
+            "attention_mask": {1: sequence_dim},
+        }
+    )
+    print(f"Exporting chunk 2 (transformer layers {split_at}-{num_layers - 1} + classifier)...")
+    exported_part2 = export_for_coreml(part2, (hidden_states, attention_mask))
+
+    print("Converting chunk 1 to Core ML...")
+    coreml_part1 = ct.convert(
+        exported_part1,
+        inputs=[
+            ct.TensorType(name="input_ids", shape=(1, seq_length), dtype=np.int32),
+            ct.TensorType(name="attention_mask", shape=(1, seq_length), dtype=np.int32)
+        ],
+        outputs=[ct.TensorType(name="hidden_states")],
+        minimum_deployment_target=ct.target.iOS18,
+        compute_units=ct.ComputeUnit.CPU_AND_NE,
+        compute_precision=ct.precision.FLOAT16
+    )
+    coreml_part1.save("BiomedicalNER_part1.mlpackage")
+    print("Chunk 1 saved to: BiomedicalNER_part1.mlpackage")
+
+    print("Converting chunk 2 to Core ML...")
+    coreml_part2 = ct.convert(
+        exported_part2,
+        inputs=[
+            ct.TensorType(name="hidden_states", shape=(1, seq_length, hidden_size), dtype=np.float32),
+            ct.TensorType(name="attention_mask", shape=(1, seq_length), dtype=np.int32)
+        ],
+        outputs=[ct.TensorType(name="logits")],
+        minimum_deployment_target=ct.target.iOS18,
+        compute_units=ct.ComputeUnit.CPU_AND_NE,
+        compute_precision=ct.precision.FLOAT16
+    )
+    coreml_part2.save("BiomedicalNER_part2.mlpackage")
+    print("Chunk 2 saved to: BiomedicalNER_part2.mlpackage")
+
+def save_pruned_classifier_model(model, input_ids, attention_mask):
+    """Emit a variant whose classifier head only keeps the entity types in
+    KEPT_ENTITY_TYPES, zeroing the other label rows so the converter can
+    store them sparsely"""
+    import copy
+
+    pruned = copy.deepcopy(model)
+    kept = 0
+    with torch.no_grad():
+        for label_id, label in pruned.config.id2label.items():
+            entity_type = label.split("-", 1)[-1]
+            if label == "O" or entity_type in KEPT_ENTITY_TYPES:
+                kept += 1
+            else:
+                # Zero the weight row for sparsity, but push the bias far
+                # negative: a constant zero logit would win the argmax
+                # whenever every kept label's logit goes negative
+                pruned.classifier.weight[label_id].zero_()
+                pruned.classifier.bias[label_id].fill_(-1e4)
+    print(f"Pruned classifier head to {kept} of {pruned.config.num_labels} labels")
+
+    class PrunedNERWrapper(torch.nn.Module):
+        def __init__(self, original_model):
+            super().__init__()
+            self.model = original_model
+
+        def forward(self, input_ids, attention_mask):
+            outputs = self.model(input_ids=input_ids, attention_mask=attention_mask)
+            return outputs.logits
+
+    wrapped = PrunedNERWrapper(pruned).eval()
+    # Dynamic sequence dim for the same reason as the chunked exports:
+    # a static 512 collapses the position-ids slice to an unsupported
+    # aten.alias
+    sequence_dim = torch.export.Dim("sequence", min=SEQUENCE_BUCKETS[0], max=SEQUENCE_BUCKETS[-1])
+    exported = export_for_coreml(
+        wrapped,
+        (input_ids, attention_mask),
+        dynamic_shapes={
+            "input_ids": {1: sequence_dim},
+            "attention_mask": {1: sequence_dim},
+        }
+    )
+
+    seq_length = input_ids.shape[1]
+    coreml_pruned = ct.convert(
+        exported,
+        inputs=[
+            ct.TensorType(name="input_ids", shape=(1, seq_length), dtype=np.int32),
+            ct.TensorType(name="attention_mask", shape=(1, seq_length), dtype=np.int32)
+        ],
+        outputs=[ct.TensorType(name="logits")],
+        minimum_deployment_target=ct.target.iOS18,
+        compute_units=ct.ComputeUnit.CPU_AND_NE,
+        compute_precision=ct.precision.FLOAT16
+    )
+
+    # Store the zeroed rows as a sparse representation
+    prune_config = OptimizationConfig(
+        global_config=OpThresholdPrunerConfig(threshold=1e-12)
+    )
+    coreml_pruned = prune_weights(coreml_pruned, prune_config)
+
+    output_path = "BiomedicalNER_pruned.mlpackage"
+    coreml_pruned.save(output_path)
+    print(f"Pruned-classifier model saved to: {output_path}")
+
+def save_joint_compressed_model(coreml_model, tokenizer):
+    """Emit a W4A8 variant: int8 activations + 4-bit palettized weights
+    with the LUT itself quantized to int8 (joint compression)"""
+    # The activation-quantizer config is still experimental, so import it
+    # here where the optional W4A8 path can't break the default conversion
+    from coremltools.optimize.coreml.experimental import OpActivationLinearQuantizerConfig
+
+    # Calibrate activation ranges with real biomedical sentences
+    encoded = tokenizer(
+        CALIBRATION_TEXTS,
+        padding="max_length",
+        truncation=True,
+        max_length=512,
+        return_tensors="np"
+    )
+    sample_data = [
+        {
+            "input_ids": encoded["input_ids"][i:i + 1].astype(np.int32),
+            "attention_mask": encoded["attention_mask"][i:i + 1].astype(np.int32)
+        }
+        for i in range(len(CALIBRATION_TEXTS))
+    ]
+
+    # 1. Quantize activations to int8 using the calibration set
+    print("Quantizing activations to int8...")
+    activation_config = OptimizationConfig(
+        global_config=OpActivationLinearQuantizerConfig(
+            mode="linear_symmetric",
+            dtype="int8"
+        )
+    )
+    compressed_model = linear_quantize_activations(
+        coreml_model, activation_config, sample_data
+    )
+
+    # 2. Palettize weights to 4-bit. The LUT defaults to fp16 here;
+    # step 3 is what quantizes it down to int8.
+    print("Palettizing weights to 4-bit...")
+    palettize_config = OptimizationConfig(
+        global_config=OpPalettizerConfig(
+            mode="kmeans",
+            nbits=4,
+            granularity="per_grouped_channel",
+            group_size=16
+        )
+    )
+    compressed_model = palettize_weights(compressed_model, palettize_config)
+
+    # 3. Joint compression: quantize the palettization LUT to int8.
+    # Must be per-tensor — the LUT's axes no longer line up with the
+    # original weight's channels, so per-channel scales are rejected.
+    print("Quantizing palettization LUT to int8...")
+    quantize_config = OptimizationConfig(
+        global_config=OpLinearQuantizerConfig(
+            mode="linear_symmetric",
+            dtype="int8",
+            granularity="per_tensor"
+        )
+    )
+    compressed_model = linear_quantize_weights(
+        compressed_model, quantize_config, joint_compression=True
+    )
+
+    output_path = "BiomedicalNER_w4a8.mlpackage"
+    compressed_model.save(output_path)
+    print(f"W4A8 joint-compressed model saved to: {output_path}")
 
 def save_tokenizer_info(tokenizer, config):
     """Save tokenizer vocab and label mappings for iOS"""
     import json
-    
-    # Save vocabulary
+    import msgpack
+    import orjson
+    import struct
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Vocabulary: the 30k-entry vocab dominates serialization time, so
+    # use orjson (C-accelerated, no pretty-printing) and also emit a
+    # msgpack copy that loads much faster on-device. The small label and
+    # special-token files stay pretty-printed JSON.
     vocab_dict = tokenizer.get_vocab()
-    with open("vocab.json", "w") as f:
-        json.dump(vocab_dict, f, indent=2)
-    
-    # Save label mappings
+
+    # Deterministic ID-ordered forms so iOS can index by token ID in O(1)
+    # without building a 30k-entry dictionary at launch: vocab.txt has
+    # one token per line (line number == token ID) and vocab.bin has
+    # length-prefixed UTF-8 entries for mmap access
+    id_to_token = [""] * len(vocab_dict)
+    for token, token_id in vocab_dict.items():
+        id_to_token[token_id] = token
+
     label_info = {
         "id2label": config.id2label,
         "label2id": config.label2id,
         "num_labels": config.num_labels
     }
-    
-    with open("labels.json", "w") as f:
-        json.dump(label_info, f, indent=2)
-    
-    # Save special tokens
+
     special_tokens = {
         "cls_token": tokenizer.cls_token,
         "sep_token": tokenizer.sep_token,
@@ -137,47 +596,93 @@ def save_tokenizer_info(tokenizer, config):
         "mask_token_id": tokenizer.mask_token_id,
         "max_length": tokenizer.model_max_length
     }
-    
-    with open("special_tokens.json", "w") as f:
-        json.dump(special_tokens, f, indent=2)
-    
+
+    def write_vocab_json():
+        with open("vocab.json", "wb") as f:
+            f.write(orjson.dumps(vocab_dict))
+
+    def write_vocab_msgpack():
+        with open("vocab.msgpack", "wb") as f:
+            f.write(msgpack.packb(vocab_dict))
+
+    def write_vocab_txt():
+        with open("vocab.txt", "w", encoding="utf-8") as f:
+            f.write("\n".join(id_to_token))
+
+    def write_vocab_bin():
+        with open("vocab.bin", "wb") as f:
+            for token in id_to_token:
+                token_bytes = token.encode("utf-8")
+                f.write(struct.pack("<H", len(token_bytes)))
+                f.write(token_bytes)
+
+    def write_labels():
+        with open("labels.json", "w") as f:
+            json.dump(label_info, f, indent=2)
+
+    def write_special_tokens():
+        with open("special_tokens.json", "w") as f:
+            json.dump(special_tokens, f, indent=2)
+
+    # The files are independent, so overlap the I/O-bound writes
+    writers = [
+        write_vocab_json,
+        write_vocab_msgpack,
+        write_vocab_txt,
+        write_vocab_bin,
+        write_labels,
+        write_special_tokens,
+    ]
+    with ThreadPoolExecutor(max_workers=len(writers)) as executor:
+        for future in [executor.submit(writer) for writer in writers]:
+            future.result()
+
     print("Tokenizer info saved:")
     print("- vocab.json (vocabulary mapping)")
+    print("- vocab.msgpack (vocabulary mapping, fast on-device load)")
+    print("- vocab.txt (ID-ordered tokens, one per line)")
+    print("- vocab.bin (ID-ordered tokens, length-prefixed for mmap)")
     print("- labels.json (entity label mappings)")
     print("- special_tokens.json (special token info)")
 
-    """Test the converted model with sample pharmaceutical text"""
-    import json
-    import coremltools as ct
-    from transformers import AutoTokenizer
-    
-    # Load the converted model
-    model = ct.models.MLModel("BiomedicalNER.mlpackage")
-    
-    # Load tokenizer and labels for testing
-    tokenizer = AutoTokenizer.from_pretrained("d4data/biomedical-ner-all")
-    
-    with open("labels.json", "r") as f:
-        label_data = json.load(f)
-        id2label = {int(k): v for k, v in label_data["id2label"].items()}
-    
+def test_conversion(model, tokenizer, id2label):
+    """Test the converted model with sample pharmaceutical text.
+
+    Takes the model, tokenizer and label mapping from the conversion step
+    so nothing gets re-loaded from disk."""
+
     # Sample pharmaceutical text
     sample_text = "Take 25mg of Lisinopril twice daily for hypertension"
     print(f"\nTesting with sample text: '{sample_text}'")
     
-    # Tokenize the sample text
+    # Tokenize the sample text, then pad only up to the next enumerated
+    # sequence bucket instead of the full 512 tokens
     encoded = tokenizer(
         sample_text,
-        padding="max_length",
+        padding="longest",
         truncation=True,
         max_length=512,
+        return_special_tokens_mask=True,
+        return_offsets_mapping=True,
         return_tensors="np"
     )
-    
+
     # Prepare inputs for Core ML
     print(encoded)
     input_ids = encoded["input_ids"].astype(np.int32)
     attention_mask = encoded["attention_mask"].astype(np.int32)
+    special_tokens_mask = encoded["special_tokens_mask"].astype(bool)
+    offset_mapping = encoded["offset_mapping"]
+
+    seq_length = input_ids.shape[1]
+    bucket = next(b for b in SEQUENCE_BUCKETS if b >= seq_length)
+    if bucket > seq_length:
+        pad = bucket - seq_length
+        input_ids = np.pad(input_ids, ((0, 0), (0, pad)), constant_values=tokenizer.pad_token_id)
+        attention_mask = np.pad(attention_mask, ((0, 0), (0, pad)))
+        # Padding counts as special so the reporting below skips it
+        special_tokens_mask = np.pad(special_tokens_mask, ((0, 0), (0, pad)), constant_values=True)
+    print(f"Padded {seq_length} tokens to the {bucket}-token bucket")
     
     # Run prediction
     try:
@@ -190,25 +695,44 @@ def save_tokenizer_info(tokenizer, config):
         print(f"Prediction successful! Logits shape: {logits.shape}")
         
         # Get predictions for each token
-        predicted_labels = np.argmax(logits[0], axis=-1)
-        tokens = tokenizer.convert_ids_to_tokens(encoded["input_ids"][0])
-        
+        # Argmax is monotonic in the logits, so labels need no softmax at
+        # all. Probabilities are only computed for the few candidate
+        # entity rows that face the confidence threshold (typically <10
+        # rows instead of the full sequence).
+        predicted_labels = logits[0].argmax(axis=-1)
+
+        # The fast tokenizer already tells us which rows are real text
+        # (Rust-produced arrays), so no string comparisons against
+        # [CLS]/[SEP]/[PAD] and no convert_ids_to_tokens round-trip
+        valid_rows = np.where(~special_tokens_mask[0])[0]
+        candidate_rows = np.array([
+            i for i in valid_rows
+            if id2label.get(predicted_labels[i], "O") != "O"
+        ], dtype=int)
+        confidences = np.zeros(predicted_labels.shape[0])
+        if candidate_rows.size:
+            candidate_probs = softmax(logits[0][candidate_rows], axis=-1)
+            confidences[candidate_rows] = candidate_probs.max(axis=-1)
+
         print("\nToken predictions:")
         print("-" * 50)
-        
+
         entities_found = []
-        for i, (token, label_id) in enumerate(zip(tokens, predicted_labels)):
-            if token in ["[CLS]", "[SEP]", "[PAD]"]:
-                continue
-                
-            label = id2label.get(label_id, "UNKNOWN")
-            confidence = np.max(softmax(logits[0][i]))
-            
-            print(f"{token:15} -> {label:20} (confidence: {confidence:.3f})")
-            
+        for i in valid_rows:
+            # Slice the original text via the offset mapping instead of
+            # decoding wordpiece strings
+            start, end = offset_mapping[0][i]
+            token_text = sample_text[start:end]
+
+            label = id2label.get(predicted_labels[i], "UNKNOWN")
+            if confidences[i]:
+                print(f"{token_text:15} -> {label:20} (confidence: {confidences[i]:.3f})")
+            else:
+                print(f"{token_text:15} -> {label:20}")
+
             # Collect entities (non-O labels with decent confidence)
-            if label != "O" and confidence > 0.5:
-                entities_found.append((token, label, confidence))
+            if label != "O" and confidences[i] > 0.5:
+                entities_found.append((token_text, label, confidences[i]))
         
         # Summary
         print(f"\nEntities found: {len(entities_found)}")
@@ -221,7 +745,54 @@ def save_tokenizer_info(tokenizer, config):
             print("  - Model needs fine-tuning on prescription text")
             print("  - Confidence threshold is too high")
             print("  - Text format differs from training data")
-        
+
+        # Chain the two chunked models and check they match the
+        # monolithic model's logits
+        part1 = ct.models.MLModel("BiomedicalNER_part1.mlpackage")
+        part2 = ct.models.MLModel("BiomedicalNER_part2.mlpackage")
+
+        # The chunked models are fixed at 512 tokens, so re-pad for them
+        pad = 512 - bucket
+        full_input_ids = np.pad(input_ids, ((0, 0), (0, pad)), constant_values=tokenizer.pad_token_id)
+        full_attention_mask = np.pad(attention_mask, ((0, 0), (0, pad)))
+
+        part1_out = part1.predict({
+            "input_ids": full_input_ids,
+            "attention_mask": full_attention_mask
+        })
+        part2_out = part2.predict({
+            "hidden_states": part1_out["hidden_states"].astype(np.float32),
+            "attention_mask": full_attention_mask
+        })
+
+        chunked_logits = part2_out["logits"]
+        max_diff = np.abs(chunked_logits[:, :bucket] - logits).max()
+        print(f"\nChunked model chained successfully! Max logit diff vs monolithic: {max_diff:.4f}")
+
+        # Bulk path: run a whole batch of sentences in one predict call
+        batch_texts = CALIBRATION_TEXTS[:BATCH_SIZE]
+        batch_encoded = tokenizer(
+            batch_texts,
+            padding="max_length",
+            truncation=True,
+            max_length=512,
+            return_tensors="np"
+        )
+        batch_prediction = model.predict({
+            "input_ids": batch_encoded["input_ids"].astype(np.int32),
+            "attention_mask": batch_encoded["attention_mask"].astype(np.int32)
+        })
+        batch_logits = batch_prediction["logits"]
+        print(f"\nBatched prediction successful! Logits shape: {batch_logits.shape}")
+
+        batch_labels = batch_logits.argmax(axis=-1)
+        for text, labels, mask in zip(batch_texts, batch_labels, batch_encoded["attention_mask"]):
+            entity_tokens = sum(
+                1 for label_id, m in zip(labels, mask)
+                if m and id2label.get(label_id, "O") != "O"
+            )
+            print(f"  {entity_tokens:2d} entity tokens in '{text}'")
+
     except Exception as e:
         print(f"Prediction failed: {e}")
         print("This might indicate:")
@@ -229,23 +800,30 @@ def save_tokenizer_info(tokenizer, config):
         print("- Model conversion issues")
         print("- Core ML compatibility problems")
 
-def softmax(x):
-    """Apply softmax to get probabilities"""
-    exp_x = np.exp(x - np.max(x))
-    return exp_x / np.sum(exp_x)
-
 if __name__ == "__main__":
     # Install required packages first:
-    # pip install torch transformers coremltools
-    
+    # pip install torch transformers coremltools scipy orjson msgpack
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert biomedical NER model to Core ML")
+    parser.add_argument(
+        "--joint-compress",
+        action="store_true",
+        help="Also emit a W4A8 joint-compressed variant (A17pro/M4-class Neural Engines)"
+    )
+    args = parser.parse_args()
+
     try:
         print("Starting biomedical NER model conversion...")
-        coreml_model = convert_biomedical_ner_to_coreml()
+        coreml_model, tokenizer, id2label = convert_biomedical_ner_to_coreml(
+            joint_compress=args.joint_compress
+        )
         print("Conversion completed successfully!")
-        
+
         # Test the conversion
-        test_conversion()
+        test_conversion(coreml_model, tokenizer, id2label)
         
     except Exception as e:
         print(f"Error during conversion: {e}")
-        print("Make sure you have installed: torch, transformers, coremltools")
\ No newline at end of file
+        print("Make sure you have installed: torch, transformers, coremltools, scipy, orjson, msgpack")
\ No newline at end of file